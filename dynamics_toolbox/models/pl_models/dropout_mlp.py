@@ -107,13 +107,13 @@ class DropoutMLP(AbstractPlModel):
         Returns:
             The output of the network.
         """
-        curr = self._net.linear_0(x)
+        curr = self._net.get_layer(0)(x)
         for layer in range(1, self._net.n_layers - 1):
             curr = getattr(self, f'_dropout_{layer}')(curr)
-            curr = getattr(self._net, f'linear_{layer}')(curr)
+            curr = self._net.get_layer(layer)(curr)
             curr = self._net.hidden_activation(curr)
         curr = getattr(self, f'_dropout_{self._net.n_layers - 1}')(curr)
-        curr = getattr(self._net, f'linear_{self._net.n_layers - 1}')(curr)
+        curr = self._net.get_layer(self._net.n_layers - 1)(curr)
         if self._net.out_activation is not None:
             return self._net.out_activation(curr)
         return curr
@@ -249,7 +249,7 @@ class DropoutMLP(AbstractPlModel):
         for lidx in range(1, self._net.n_layers):
             masks.append(self._dropout_dist.sample((
                 num_inputs,
-                getattr(self._net, f'linear_{lidx}').in_features)).to(self.device))
+                self._net.get_layer(lidx).in_features)).to(self.device))
         return masks
 
     def _forward_with_specified_mask(
@@ -271,13 +271,13 @@ class DropoutMLP(AbstractPlModel):
             The output of the network.
         """
         with torch.no_grad():
-            curr = self._net.linear_0(x)
+            curr = self._net.get_layer(0)(x)
             for layer, mask in enumerate(masks[:-1]):
                 curr *= mask
-                curr = getattr(self._net, f'linear_{layer + 1}')(curr)
+                curr = self._net.get_layer(layer + 1)(curr)
                 curr = self._net.hidden_activation(curr)
             curr *= masks[-1]
-            curr = getattr(self._net, f'linear_{self._net.n_layers - 1}')(curr)
+            curr = self._net.get_layer(self._net.n_layers - 1)(curr)
         if self._net.out_activation is not None:
             return self._net.out_activation(curr)
         return curr
@@ -32,6 +32,8 @@ class MLP(AbstractPlModel):
             out_activation: Optional[str] = None,
             loss_type: str = losses.MSE,
             weight_decay: Optional[float] = 0.0,
+            dtype: str = 'float32',
+            autocast: bool = False,
             **kwargs,
     ):
         """Constructor.
@@ -49,6 +51,8 @@ class MLP(AbstractPlModel):
             out_activation: Activation to use on the output.
             loss_type: The name of the loss function to use.
             weight_decay: The weight decay for the optimizer.
+            dtype: The name of the dtype of the network parameters.
+            autocast: Whether to run the network under bfloat16 autocast.
         """
         super().__init__(input_dim, output_dim, **kwargs)
         hidden_sizes = get_architecture(num_layers, layer_size, architecture)
@@ -58,6 +62,8 @@ class MLP(AbstractPlModel):
             hidden_sizes=hidden_sizes,
             hidden_activation=get_activation(hidden_activation),
             out_activation=get_activation(out_activation),
+            dtype=dtype,
+            autocast=autocast,
         )
         self._learning_rate = learning_rate
         self._weight_decay = weight_decay
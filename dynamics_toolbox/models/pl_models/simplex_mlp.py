@@ -317,7 +317,7 @@ class SimplexMLP(AbstractPlModel):
         Returns:
             The specified layer.
         """
-        return getattr(getattr(self, f'_vertex_{vert_num}'), f'linear_{layer_num}')
+        return getattr(self, f'_vertex_{vert_num}').get_layer(layer_num)
 
     def _get_interior_layer(
             self,
@@ -0,0 +1,217 @@
+"""
+Numba kernels for writing into the sequential replay buffer.
+
+The kernels are given explicit signatures so that they are compiled, or loaded
+from the on disk cache, when this module is imported rather than on first use.
+Inputs are read through any layout while the buffers must be C contiguous.
+"""
+from typing import Tuple
+
+import numpy as np
+from numba import njit, prange
+
+# Bits of the per step flags.
+TERMINAL_FLAG = 1
+MASK_FLAG = 2
+
+
+@njit(
+    'i8(f4[:, :], f4[:], f4[:, :], f4[:, :], f4[:, :], i8, f4[:, ::1], f4[:, ::1], '
+    'f4[:, ::1], u1[:, ::1], i8[::1], i8, i8, i8, i8)',
+    cache=True,
+    boundscheck=False,
+)
+def ingest_path(
+    obs: np.ndarray,
+    final_obs: np.ndarray,
+    acts: np.ndarray,
+    rews: np.ndarray,
+    terms: np.ndarray,
+    length: int,
+    step_obs: np.ndarray,
+    step_act: np.ndarray,
+    step_rew: np.ndarray,
+    step_flags: np.ndarray,
+    window_starts: np.ndarray,
+    step_top: int,
+    num_steps: int,
+    top: int,
+    lookback: int,
+) -> int:
+    """Write one path into the step buffers and add its windows.
+
+    Args:
+        obs: The observations of the path w shape (horizon, obs_dim). Any extra
+            rows after this are ignored.
+        final_obs: The next observation of the last real step w shape (obs_dim,).
+        acts: The actions of the path w shape (horizon, act_dim).
+        rews: The rewards of the path w shape (horizon, 1).
+        terms: The terminals of the path w shape (horizon, 1).
+        length: The number of real time steps in the path.
+        step_obs: The observation step buffer, whose size is a power of two.
+        step_act: The action step buffer.
+        step_rew: The reward step buffer.
+        step_flags: The flag step buffer.
+        window_starts: The buffer of absolute window starts, whose size is a power
+            of two.
+        step_top: Where in the step buffers to start writing.
+        num_steps: The absolute number of the first step being written.
+        top: Where in the window buffer to start writing.
+        lookback: The lookback of the windows.
+
+    Returns: The number of windows that were added.
+    """
+    # The buffers have a power of two size, so indices wrap with a bit mask.
+    step_mask = step_obs.shape[0] - 1
+    window_mask = window_starts.shape[0] - 1
+    # Write the steps of the path followed by the final next observation.
+    for t in range(length + 1):
+        row = (step_top + t) & step_mask
+        if t < length:
+            for d in range(obs.shape[1]):
+                step_obs[row, d] = obs[t, d]
+            for d in range(acts.shape[1]):
+                step_act[row, d] = acts[t, d]
+            step_rew[row, 0] = rews[t, 0]
+            if terms[t, 0] != 0:
+                step_flags[row, 0] = TERMINAL_FLAG + MASK_FLAG
+            else:
+                step_flags[row, 0] = MASK_FLAG
+        else:
+            for d in range(obs.shape[1]):
+                step_obs[row, d] = final_obs[d]
+            step_flags[row, 0] = 0
+    # There is a window for every start with a full lookback behind it, or
+    # a single shorter window if the path is shorter than the lookback.
+    n_windows = max(length - lookback + 1, 1)
+    for w in range(n_windows):
+        window_starts[(top + w) & window_mask] = num_steps + w
+    return n_windows
+
+
+@njit(
+    'i8(f4[:, :], f4[:, :], f4[:, :], f4[:, :], f4[:, :], i8[:], i8[:], f4[:, ::1], '
+    'f4[:, ::1], f4[:, ::1], u1[:, ::1], i8[::1], i8, i8, i8, i8)',
+    cache=True,
+    boundscheck=False,
+    parallel=True,
+)
+def ingest_paths(
+    obs: np.ndarray,
+    final_obs: np.ndarray,
+    acts: np.ndarray,
+    rews: np.ndarray,
+    terms: np.ndarray,
+    path_starts: np.ndarray,
+    path_lengths: np.ndarray,
+    step_obs: np.ndarray,
+    step_act: np.ndarray,
+    step_rew: np.ndarray,
+    step_flags: np.ndarray,
+    window_starts: np.ndarray,
+    step_top: int,
+    num_steps: int,
+    top: int,
+    lookback: int,
+) -> int:
+    """Write paths stored back to back in flat arrays, one after the other.
+
+    The paths are split between numba's threads, so the paths and their windows
+    must all fit in the buffers without wrapping onto each other.
+
+    Args:
+        obs: The observations of all the paths w shape (num_steps, obs_dim).
+        final_obs: The final next observation of each path w shape
+            (num_paths, obs_dim).
+        acts: The actions of all the paths w shape (num_steps, act_dim).
+        rews: The rewards of all the paths w shape (num_steps, 1).
+        terms: The terminals of all the paths w shape (num_steps, 1).
+        path_starts: The row each path starts at w shape (num_paths,).
+        path_lengths: The number of time steps in each path w shape (num_paths,).
+        step_obs: The observation step buffer, whose size is a power of two.
+        step_act: The action step buffer.
+        step_rew: The reward step buffer.
+        step_flags: The flag step buffer.
+        window_starts: The buffer of absolute window starts, whose size is a power
+            of two.
+        step_top: Where in the step buffers to start writing.
+        num_steps: The absolute number of the first step being written.
+        top: Where in the window buffer to start writing.
+        lookback: The lookback of the windows.
+
+    Returns: The number of windows that were added.
+    """
+    # Work out where every path goes first so that the paths, which write to
+    # disjoint rows, can then be written in parallel.
+    num_paths = path_starts.shape[0]
+    step_offsets = np.empty(num_paths, dtype=np.int64)
+    window_offsets = np.empty(num_paths, dtype=np.int64)
+    n_steps = 0
+    n_windows = 0
+    for p in range(num_paths):
+        step_offsets[p] = n_steps
+        window_offsets[p] = n_windows
+        n_steps += path_lengths[p] + 1
+        n_windows += max(path_lengths[p] - lookback + 1, 1)
+    for p in prange(num_paths):
+        start = path_starts[p]
+        end = start + path_lengths[p]
+        ingest_path(
+            obs[start:end],
+            final_obs[p],
+            acts[start:end],
+            rews[start:end],
+            terms[start:end],
+            path_lengths[p],
+            step_obs,
+            step_act,
+            step_rew,
+            step_flags,
+            window_starts,
+            step_top + step_offsets[p],
+            num_steps + step_offsets[p],
+            top + window_offsets[p],
+            lookback,
+        )
+    return n_windows
+
+
+@njit('UniTuple(i8[:], 2)(f4[:, :], f4[:, :], f4[:, :])', cache=True)
+def episode_bounds(
+    observations: np.ndarray,
+    next_observations: np.ndarray,
+    terminals: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the episodes in a flat dataset in one pass.
+
+    The episodes are split in the same places as parse_into_trajectories, i.e.
+    after a terminal or wherever a next observation does not match the following
+    observation. Like parse_into_trajectories, the last transition is left out.
+
+    Args:
+        observations: The observations w shape (num_transitions, obs_dim).
+        next_observations: The next observations w shape (num_transitions, obs_dim).
+        terminals: The terminals w shape (num_transitions, 1).
+
+    Returns: The index each episode starts at and the length of each episode, both
+        w shape (num_episodes,).
+    """
+    num_transitions = observations.shape[0]
+    starts = np.empty(num_transitions, dtype=np.int64)
+    lengths = np.empty(num_transitions, dtype=np.int64)
+    num_episodes = 0
+    start = 0
+    for end in range(1, num_transitions):
+        split = end == num_transitions - 1 or terminals[end - 1, 0] != 0
+        for d in range(observations.shape[1]):
+            if split:
+                break
+            # Same tolerances as np.allclose.
+            split = not (abs(next_observations[end - 1, d] - observations[end, d])
+                         <= 1e-8 + 1e-5 * abs(observations[end, d]))
+        if split:
+            starts[num_episodes] = start
+            lengths[num_episodes] = end - start
+            num_episodes += 1
+            start = end
+    return starts[:num_episodes], lengths[:num_episodes]
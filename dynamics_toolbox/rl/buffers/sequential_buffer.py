@@ -1,16 +1,20 @@
 """
 A replay buffer that holds sequential information.
 
-NOTE: This is a really bad way of implementing it. I basically take simple replay
-buffer and multiply it by lookback size. A lot of unforseen difficulties come up
-if you try to do it any smarter way, especially if dealing with an episode that
-terminates early.
+Every time step is stored once in a flat ring of steps. Each path writes its real
+time steps followed by one extra step holding its final next observation, so that
+the next observations of a window are just the steps one further along. A second
+ring holds the step that each window (i.e. subsequence of length lookback) starts
+at, and the windows are gathered out of the step ring when sampling. Like a ring of
+windows, the buffer keeps the most recent max_buffer_size windows. The step ring
+is sized so that it always has the steps of those windows.
 
 Author: Ian Char
 Date: April 13, 2023
 """
 from typing import Dict, Union, Tuple, Optional
 
+import numba
 import numpy as np
 import torch
 
@@ -21,7 +25,13 @@ from dynamics_toolbox.rl.modules.history_encoders.abstract_history_encoder impor
     HistoryEncoder,
 )
 from dynamics_toolbox.rl.buffers.abstract_buffer import ReplayBuffer
-from dynamics_toolbox.utils.sarsa_data_util import parse_into_trajectories
+from dynamics_toolbox.rl.buffers._seq_buffer_numba import (
+    episode_bounds,
+    ingest_path,
+    ingest_paths,
+    MASK_FLAG,
+    TERMINAL_FLAG,
+)
 from dynamics_toolbox.utils.pytorch.device_utils import MANAGER as dm
 
 
@@ -34,7 +44,8 @@ class SequentialReplayBuffer(ReplayBuffer):
         max_buffer_size: int,
         lookback: int,
         clear_every_n_epochs: int = -1,
-        encoding_dims: Optional[Dict[str, int]] = None
+        encoding_dims: Optional[Dict[str, int]] = None,
+        max_steps: Optional[int] = None,
     ):
         """
         Constructor.
@@ -42,16 +53,39 @@ class SequentialReplayBuffer(ReplayBuffer):
         Args:
             obs_dim: Dimension of the observation space.
             act_dim: Dimension of the action space.
-            max_buffer_size: The maximum buffer size.
+            max_buffer_size: The maximum number of windows to store.
             lookback: How big the lookback should be.
             clear_every_n_epochs: Whether to clear the buffer after every epoch.
             q_encoding_dim: Optionally the replay buffer can also store encodings
                 of the past up to this point.
+            max_steps: The number of time steps to make room for, where every path
+                uses one extra step for its final next observation. By default
+                this is enough for max_buffer_size windows from paths of any
+                length. If it is smaller, windows are also dropped once the steps
+                they start at have been overwritten.
         """
         self._obs_dim = obs_dim
         self._act_dim = act_dim
         self._max_size = int(max_buffer_size)
+        # A window uses at most lookback + 1 steps of its own, counting the final
+        # next observation of short paths, so this many steps always covers the
+        # most recent max_size windows.
+        if max_steps is None:
+            max_steps = (lookback + 1) * self._max_size
+        # The rings are rounded up to a power of two so that indices can be
+        # wrapped with a bit mask. Windows past max_size are still treated as
+        # gone, so the extra room only changes where things get written.
+        self._window_capacity = 1 << (self._max_size - 1).bit_length()
+        self._window_mask = self._window_capacity - 1
+        self._step_capacity = 1 << (int(max_steps) - 1).bit_length()
+        self._step_mask = self._step_capacity - 1
+        # Seeded from the global generator so that seeding numpy still makes the
+        # sampling reproducible.
+        self._rng = np.random.default_rng(np.random.randint(2 ** 31))
         self._lookback = lookback
+        # Offsets of the steps in a window from its start, kept to avoid remaking
+        # them for every batch.
+        self._window_offsets = np.arange(lookback)
         self._clear_every_n_epochs = clear_every_n_epochs
         self.encoding_dims = encoding_dims
         self._countdown_to_clear = (float('inf') if clear_every_n_epochs < 1
@@ -60,57 +94,39 @@ class SequentialReplayBuffer(ReplayBuffer):
 
     def clear_buffer(self):
         """Clear all of the buffers."""
-        self._observations = np.zeros((
-            self._max_size,
-            self._lookback,
-            self._obs_dim,
-        ))
-        self._next_observations = np.zeros((
-            self._max_size,
-            self._lookback,
-            self._obs_dim,
-        ))
+        self._step_obs = np.zeros((self._step_capacity, self._obs_dim),
+                                  dtype=np.float32)
+        self._step_act = np.zeros((self._step_capacity, self._act_dim),
+                                  dtype=np.float32)
+        self._step_rew = np.zeros((self._step_capacity, 1), dtype=np.float32)
+        # Terminals and masks are packed into one byte per step. The mask bit is
+        # only off for the extra step holding the final next observation of a path,
+        # so a window is real up until the first step without it.
+        self._step_flags = np.zeros((self._step_capacity, 1), dtype=np.uint8)
+        # Windows are stored as the absolute number of the step they start at so
+        # that we can tell when it is too old.
+        self._window_starts = np.zeros(self._window_capacity, dtype=np.int64)
         # Encodings are only saved for the start of the subsequence since we
         # expect the network to re-encode when training. In other words, the
         # buffers here are 2D since they have no lookback.
         if self.encoding_dims is not None:
             for k, v in self.encoding_dims.items():
                 setattr(self, f'_{k}_encoding', np.zeros((
-                    self._max_size,
+                    self._window_capacity,
                     v
-                )))
-        # NOTE: actions and rewards have one padding at the beginning. This is because
-        # when encoding for the first time step we need to encode previous actions
-        # and rewards but there are none at that point.
-        self._actions = np.zeros((
-            self._max_size,
-            self._lookback + 1,
-            self._act_dim,
-        ))
-        self._rewards = np.zeros((
-            self._max_size,
-            self._lookback + 1,
-            1,
-        ))
-        self._terminals = np.zeros((
-            self._max_size,
-            self._lookback,
-            1,
-        ), dtype='uint8')
-        self._masks = np.zeros((
-            self._max_size,
-            self._lookback,
-            1,
-        ), dtype='uint8')
+                ), dtype=np.float32))
+        self._sample_scratch = None
+        self._sample_flags = None
+        self._sample_rows = None
+        self._sample_next_rows = None
+        self._step_top = 0
+        self._num_steps = 0
         self._top = 0
         self._size = 0
 
     def add_paths(self, paths: Dict[str, np.ndarray]):
         """Add paths taken in the environment.
 
-        TODO: This could be optimized by removing the nested for loops and adding
-              multiple paths at once. More logic is needed though.
-
         Args:
             Dict with...
             observations: The observations with shape (num_paths, horizon + 1, obs_dim)
@@ -125,41 +141,43 @@ class SequentialReplayBuffer(ReplayBuffer):
                 masks: shape (num_paths, horizon, 1) or (horizon, 1).
                 encodings: shape (num_paths, horizon, encoding_dim)
         """
-        if len(paths['actions'].shape) < 3:
-            paths = {k: v[np.newaxis] for k, v in paths.items()}
-        paths['next_observations'] = paths['observations'][:, 1:]
-        paths['observations'] = paths['observations'][:, :-1]
-        for pidx in range(len(paths['actions'])):
-            path = {}
-            for k, v in paths.items():
-                if k != 'info':
-                    path[k] = v[pidx]
-            length = None
-            if 'masks' in path:
-                idxs = np.argwhere(path['masks'] - 1).flatten()
-                if len(idxs):
-                    length = idxs[0]
-            if length is None:
-                length = len(path['actions'])
-            for strt in range(0, max(length - self._lookback + 1, 1)):
-                end = min(strt + self._lookback, strt + length)
-                for k, buff in (('actions', self._actions), ('rewards', self._rewards)):
-                    buff[self._top, 1:end - strt + 1] = path[k][strt:end]
-                for k, buff in (
-                        ('observations', self._observations),
-                        ('next_observations', self._next_observations),
-                        ('terminals', self._terminals)):
-                    buff[self._top, :end - strt] = path[k][strt:end]
-                if 'masks' in path:
-                    self._masks[self._top, :end - strt] = path['masks'][strt:end]
-                else:
-                    self._masks[self._top, :end - strt] = 1
-                # Possibly store encodings.
-                for k, v in path.items():
-                    if 'encoding' in k and hasattr(self, f'_{k}'):
-                        getattr(self, f'_{k}')[self._top] = v[strt]
-                self._masks[self._top, end - strt:] = 0
-                self._advance()
+        # Everything is made contiguous float32 once here so that the kernel reads
+        # each path sequentially and nothing is converted again per path.
+        observations = np.ascontiguousarray(paths['observations'], dtype=np.float32)
+        actions = np.ascontiguousarray(paths['actions'], dtype=np.float32)
+        rewards = np.ascontiguousarray(paths['rewards'], dtype=np.float32)
+        terminals = np.ascontiguousarray(paths['terminals'], dtype=np.float32)
+        masks = paths.get('masks', None)
+        encodings = {k: v for k, v in paths.items() if 'encoding' in k}
+        if len(actions.shape) < 3:
+            # A single path is treated as a batch of one. Only the arrays that
+            # get used are given the extra axis and the passed in dict is left as is.
+            observations = observations[np.newaxis]
+            actions = actions[np.newaxis]
+            rewards = rewards[np.newaxis]
+            terminals = terminals[np.newaxis]
+            if masks is not None:
+                masks = masks[np.newaxis]
+            encodings = {k: v[np.newaxis] for k, v in encodings.items()}
+        # The length of every path is worked out once for all of the paths rather
+        # than inside the loop.
+        num_paths, horizon = actions.shape[:2]
+        if masks is not None:
+            # Paths end at their first time step that is not masked in.
+            unmasked = masks[..., 0] != 1
+            lengths = np.where(unmasked.any(axis=1), unmasked.argmax(axis=1), horizon)
+        else:
+            lengths = np.full(num_paths, horizon)
+        for pidx, length in enumerate(lengths):
+            self._add_path(
+                obs=observations[pidx],
+                final_obs=observations[pidx, length],
+                acts=actions[pidx],
+                rews=rewards[pidx],
+                terms=terminals[pidx],
+                length=length,
+                encodings={k: v[pidx] for k, v in encodings.items()},
+            )
 
     def sample_batch(self, num_samples: int) -> Dict[str, np.ndarray]:
         """Get a random batch of data.
@@ -174,19 +192,9 @@ class SequentialReplayBuffer(ReplayBuffer):
             next_observations: This is a history of nexts (batch_size, L, obs_dim)
             terminals: Whether last time step is terminals (batch_size, L, 1)
             masks: Masks of what is real and what data (batch_size, L, 1).
+            The arrays are reused by the next call to sample_batch.
         """
-        indices = np.random.randint(0, self._size, num_samples)
-        batch = {}
-        batch['observations'] = self._observations[indices]
-        batch['next_observations'] = self._next_observations[indices]
-        batch['actions'] = self._actions[indices]
-        batch['rewards'] = self._rewards[indices]
-        batch['terminals'] = self._terminals[indices]
-        batch['masks'] = self._masks[indices]
-        if self.encoding_dims is not None:
-            for k in self.encoding_dims.keys():
-                batch[f'{k}_encoding'] = getattr(self, f'_{k}_encoding')[indices]
-        return batch
+        return self._gather_windows(self._sample_window_idxs(num_samples))
 
     def sample_starts(self, num_samples: int) -> np.ndarray:
         """Get a random batch of data.
@@ -198,8 +206,10 @@ class SequentialReplayBuffer(ReplayBuffer):
         """
         # TODO: Currently this has a slight bug where we do not consider all of the
         # states for start states. Just the first state in the window.
-        indices = np.random.randint(0, self._size, num_samples)
-        return self._observations[indices][:, 0]
+        # Only the start row of each window is gathered.
+        indices = self._sample_window_idxs(num_samples)
+        return np.take(self._step_obs, self._window_starts[indices] & self._step_mask,
+                       axis=0, mode='clip')
 
     def add_step(
         self,
@@ -214,10 +224,164 @@ class SequentialReplayBuffer(ReplayBuffer):
         """
         raise NotImplementedError('This would require a lot more logic :(')
 
-    def _advance(self):
-        self._top = (self._top + 1) % self._max_size
-        if self._size < self._max_size:
-            self._size += 1
+    def _add_path(
+        self,
+        obs: np.ndarray,
+        final_obs: np.ndarray,
+        acts: np.ndarray,
+        rews: np.ndarray,
+        terms: np.ndarray,
+        length: int,
+        encodings: Dict[str, np.ndarray],
+    ):
+        """Add a single path to the buffer.
+
+        Args:
+            obs: The observations w shape (horizon, obs_dim). Extra rows are ignored.
+            final_obs: The next observation of the last real step w shape (obs_dim,).
+            acts: The actions w shape (horizon, act_dim).
+            rews: The rewards w shape (horizon, 1).
+            terms: The terminals w shape (horizon, 1).
+            length: The number of real time steps in the path.
+            encodings: Name of encoding to encodings w shape (horizon, encoding_dim).
+        """
+        n_windows = ingest_path(
+            obs,
+            final_obs,
+            acts,
+            rews,
+            terms,
+            length,
+            self._step_obs,
+            self._step_act,
+            self._step_rew,
+            self._step_flags,
+            self._window_starts,
+            self._step_top,
+            self._num_steps,
+            self._top,
+            self._lookback,
+        )
+        # Possibly store encodings. If the path has more windows than the ring
+        # holds then only the ones that were not written over are kept.
+        first_kept = max(n_windows - self._window_capacity, 0)
+        win_idxs = (np.arange(self._top + first_kept, self._top + n_windows)
+                    & self._window_mask)
+        for k, v in encodings.items():
+            if hasattr(self, f'_{k}'):
+                getattr(self, f'_{k}')[win_idxs] = v[first_kept:n_windows]
+        self._step_top = (self._step_top + length + 1) & self._step_mask
+        self._num_steps += length + 1
+        self._top = (self._top + n_windows) & self._window_mask
+        self._size = min(self._size + n_windows, self._max_size)
+        self._drop_stale_windows(length + 1)
+
+    def _sample_window_idxs(self, num_samples: int) -> np.ndarray:
+        """Sample indices of windows that are currently in the buffer.
+
+        Args:
+            num_samples: The number of indices to sample.
+
+        Returns: The window indices w shape (num_samples,).
+        """
+        offsets = self._rng.integers(self._size, size=num_samples)
+        return (self._top - self._size + offsets) & self._window_mask
+
+    def _gather_windows(self, indices: np.ndarray) -> Dict[str, np.ndarray]:
+        """Gather windows out of the step buffers.
+
+        The windows are gathered into pre-allocated arrays, meaning that the arrays
+        returned get overwritten by the next call.
+
+        Args:
+            indices: The indices of the windows w shape (batch_size,).
+
+        Returns: Dictionary of information with the shapes listed in sample_batch.
+        """
+        # Sorting makes the reads from the step buffers closer to sequential.
+        indices = np.sort(indices)
+        batch = self._get_sample_scratch(len(indices))
+        # The last batch may still be being copied to the gpu.
+        dm.wait_for_host_copies()
+        rows, next_rows = self._sample_rows, self._sample_next_rows
+        np.add(self._window_starts[indices, np.newaxis], self._window_offsets,
+               out=rows)
+        np.add(rows, 1, out=next_rows)
+        next_rows &= self._step_mask
+        rows &= self._step_mask
+        # The rows are all in bounds, and clipping stops np.take from buffering.
+        np.take(self._step_obs, rows, axis=0, mode='clip',
+                out=batch['observations'])
+        np.take(self._step_obs, next_rows, axis=0, mode='clip',
+                out=batch['next_observations'])
+        # NOTE: actions and rewards have one padding at the beginning. This is because
+        # when encoding for the first time step we need to encode previous actions
+        # and rewards but there are none at that point.
+        np.take(self._step_act, rows, axis=0, mode='clip',
+                out=batch['actions'][:, 1:])
+        np.take(self._step_rew, rows, axis=0, mode='clip',
+                out=batch['rewards'][:, 1:])
+        np.take(self._step_flags, rows, axis=0, mode='clip', out=self._sample_flags)
+        np.bitwise_and(self._sample_flags, TERMINAL_FLAG, out=batch['terminals'])
+        np.bitwise_and(self._sample_flags, MASK_FLAG, out=batch['masks'])
+        np.logical_and.accumulate(batch['masks'], axis=1, out=batch['masks'])
+        if self.encoding_dims is not None:
+            for k in self.encoding_dims.keys():
+                np.take(getattr(self, f'_{k}_encoding'), indices, axis=0,
+                        out=batch[f'{k}_encoding'])
+        return dict(batch)
+
+    def _get_sample_scratch(self, num_samples: int) -> Dict[str, np.ndarray]:
+        """Get the pre-allocated arrays to gather a batch into.
+
+        Args:
+            num_samples: The number of samples in the batch.
+
+        Returns: Dictionary of the arrays, which are reallocated if the number of
+            samples changed.
+        """
+        if (self._sample_scratch is None
+                or len(self._sample_flags) != num_samples):
+            # The arrays are pinned when training on the gpu so that moving the
+            # batch over does not block.
+            self._sample_scratch = {
+                'observations': dm.host_zeros(
+                    num_samples, self._lookback, self._obs_dim),
+                'next_observations': dm.host_zeros(
+                    num_samples, self._lookback, self._obs_dim),
+                'actions': dm.host_zeros(
+                    num_samples, self._lookback + 1, self._act_dim),
+                'rewards': dm.host_zeros(num_samples, self._lookback + 1, 1),
+                'terminals': dm.host_zeros(
+                    num_samples, self._lookback, 1, dtype=torch.uint8),
+                'masks': dm.host_zeros(
+                    num_samples, self._lookback, 1, dtype=torch.uint8),
+            }
+            if self.encoding_dims is not None:
+                for k, v in self.encoding_dims.items():
+                    self._sample_scratch[f'{k}_encoding'] = dm.host_zeros(
+                        num_samples, v)
+            self._sample_flags = np.empty((num_samples, self._lookback, 1),
+                                          dtype=np.uint8)
+            self._sample_rows = np.empty((num_samples, self._lookback),
+                                         dtype=np.int64)
+            self._sample_next_rows = np.empty_like(self._sample_rows)
+        return self._sample_scratch
+
+    def _drop_stale_windows(self, num_new_steps: int):
+        """Drop the oldest windows whose start step has been written over.
+
+        This only happens when max_steps was set lower than what max_size windows
+        can need, or when a single path is longer than the step ring.
+
+        Args:
+            num_new_steps: The number of steps that were just written. At most this
+                many windows can have gone stale.
+        """
+        oldest = ((self._top - self._size + np.arange(min(self._size, num_new_steps)))
+                  & self._window_mask)
+        self._size -= int(np.searchsorted(self._window_starts[oldest],
+                                          self._num_steps - self._step_capacity))
 
     def to_forward_dynamics_module(
         self,
@@ -239,12 +403,16 @@ class SequentialOfflineReplayBuffer(SequentialReplayBuffer):
         self,
         data: Dict[str, np.ndarray],
         lookback: int,
+        num_workers: int = 1,
         **kwargs
     ):
         """Constructor.
 
         Args:
             data with observations, next_observations, rewards, actions, terminals.
+            lookback: How big the lookback should be.
+            num_workers: The number of threads used to write the paths into the
+                buffer. This is capped at the number of threads numba has.
         """
         encoding_dims = None
         for k, v in data.items():
@@ -252,25 +420,41 @@ class SequentialOfflineReplayBuffer(SequentialReplayBuffer):
                 if encoding_dims is None:
                     encoding_dims = {}
                 encoding_dims[k] = v.shape[-1]
+        data['rewards'] = data['rewards'].reshape(-1, 1)
+        data['terminals'] = data['terminals'].reshape(-1, 1)
+        # Within a path the next observations are just the observations shifted
+        # by one, so only the final next observation of each path is kept.
+        flat_data = {k: np.ascontiguousarray(data[k], dtype=np.float32)
+                     for k in ('observations', 'actions', 'rewards', 'terminals')}
+        path_starts, path_lengths = episode_bounds(
+            flat_data['observations'],
+            np.asarray(data['next_observations'], dtype=np.float32),
+            flat_data['terminals'],
+        )
+        # There are never more windows than transitions, while every path needs
+        # one more step for its final next observation.
         super().__init__(
             obs_dim=data['observations'].shape[-1],
             act_dim=data['actions'].shape[-1],
             max_buffer_size=len(data['actions']),
             lookback=lookback,
             encoding_dims=encoding_dims,
+            max_steps=len(data['actions']) + len(path_starts),
         )
         self._starts = data['observations']
-        data['rewards'] = data['rewards'].reshape(-1, 1)
-        data['terminals'] = data['terminals'].reshape(-1, 1)
-        self._paths = parse_into_trajectories(data)
+        self._data = flat_data
+        self._final_obs = np.ascontiguousarray(
+            data['next_observations'][path_starts + path_lengths - 1],
+            dtype=np.float32,
+        )
+        self._path_starts = path_starts
+        self._path_lengths = path_lengths
+        self._paths = [{k: v[strt:strt + length] for k, v in self._data.items()}
+                       for strt, length in zip(path_starts, path_lengths)]
+        self._num_workers = min(max(num_workers, 1), numba.config.NUMBA_NUM_THREADS)
         self._clear_every_n_epochs = float('inf')
         self._countdown_to_clear = float('inf')
-        for path in self._paths:
-            path['observations'] = np.concatenate([
-                path['observations'],
-                path['next_observations'][[0]],
-            ], axis=0)
-            self.add_paths(path)
+        self._add_offline_paths()
 
     def sample_starts(self, num_samples: int) -> Tuple[np.ndarray, Dict]:
         """Get a random batch of data.
@@ -280,7 +464,7 @@ class SequentialOfflineReplayBuffer(SequentialReplayBuffer):
 
         Returns: Start states (num_samples, obs_dim)
         """
-        indices = np.random.randint(0, len(self._starts), num_samples)
+        indices = self._rng.integers(len(self._starts), size=num_samples)
         if self.encoding_dims is None:
             return self._starts[indices], {}
         return self._starts[indices], {
@@ -298,8 +482,11 @@ class SequentialOfflineReplayBuffer(SequentialReplayBuffer):
             history_encoders: Name to history encoder.
         """
         self.encoding_dims = {}
-        for path in self._paths:
-            obs_seq = dm.torch_ify(path['observations'][np.newaxis])
+        for path, final_obs in zip(self._paths, self._final_obs):
+            obs_seq = dm.torch_ify(np.concatenate([
+                path['observations'],
+                final_obs[np.newaxis],
+            ], axis=0)[np.newaxis])
             act_seq = dm.torch_ify(np.concatenate([
                 np.zeros((1, 1, self._act_dim)),
                 path['actions'][np.newaxis],
@@ -336,5 +523,54 @@ class SequentialOfflineReplayBuffer(SequentialReplayBuffer):
                 ], axis=1).squeeze(0)
                 self.encoding_dims[k] = encoding.shape[-1]
         self.clear_buffer()
-        for path in self._paths:
-            self.add_paths(path)
+        self._add_offline_paths()
+
+    def _add_offline_paths(self):
+        """Add all of the paths in the dataset to the buffer.
+
+        The steps of every path are written by a single kernel call straight from
+        the flat dataset, with the paths split between num_workers threads. Only
+        the encodings, which are stored per path, are gathered in python.
+        """
+        num_new_steps = int(self._path_lengths.sum()) + len(self._path_lengths)
+        path_windows = np.maximum(self._path_lengths - self._lookback + 1, 1)
+        if (num_new_steps > self._step_capacity
+                or path_windows.sum() > self._window_capacity):
+            raise ValueError('The paths do not fit in the buffer.')
+        num_threads = numba.get_num_threads()
+        numba.set_num_threads(self._num_workers)
+        try:
+            n_windows = ingest_paths(
+                self._data['observations'],
+                self._final_obs,
+                self._data['actions'],
+                self._data['rewards'],
+                self._data['terminals'],
+                self._path_starts,
+                self._path_lengths,
+                self._step_obs,
+                self._step_act,
+                self._step_rew,
+                self._step_flags,
+                self._window_starts,
+                self._step_top,
+                self._num_steps,
+                self._top,
+                self._lookback,
+            )
+        finally:
+            numba.set_num_threads(num_threads)
+        # Possibly store encodings.
+        encoding_keys = [k for k in (self._paths[0] if self._paths else {})
+                         if 'encoding' in k and hasattr(self, f'_{k}')]
+        if len(encoding_keys):
+            win_idxs = np.arange(self._top, self._top + n_windows) & self._window_mask
+            for k in encoding_keys:
+                getattr(self, f'_{k}')[win_idxs] = np.concatenate([
+                    path[k][:n] for path, n in zip(self._paths, path_windows)
+                ], axis=0)
+        self._step_top = (self._step_top + num_new_steps) & self._step_mask
+        self._num_steps += num_new_steps
+        self._top = (self._top + n_windows) & self._window_mask
+        self._size = min(self._size + n_windows, self._max_size)
+        self._drop_stale_windows(num_new_steps)
@@ -4,7 +4,7 @@ A standard Q network.
 Author: Ian Char
 Date: April 6, 2023
 """
-from typing import Callable, Optional, Sequence
+from typing import Callable, Optional, Sequence, Union
 
 import torch
 from torch import Tensor
@@ -26,6 +26,8 @@ class QNet(FCNetwork):
         hidden_sizes: Sequence[int],
         hidden_activation: Callable[[Tensor], Tensor] = F.relu,
         input_dim: Optional[int] = None,
+        dtype: Union[str, torch.dtype] = torch.float32,
+        autocast: bool = False,
         **kwargs
     ):
         """Constructor.
@@ -34,12 +36,16 @@ class QNet(FCNetwork):
         act_dim: Action dimension size.
         hidden_sizes: Number of hidden units for each hidden layer.
         hidden_activation: Activation function.
+        dtype: The dtype of the parameters, see FCNetwork.
+        autocast: Whether to run under bfloat16 autocast, see FCNetwork.
         """
         super().__init__(
             input_dim=obs_dim + act_dim if input_dim is None else input_dim,
             output_dim=1,
             hidden_sizes=hidden_sizes,
             hidden_activation=hidden_activation,
+            dtype=dtype,
+            autocast=autocast,
         )
         self._obs_dim = obs_dim
         self._act_dim = act_dim
@@ -50,11 +50,7 @@ def construct_all_pl_components_for_training(
     elif cfg['normalization'] == 'standardize':
         normconst_path = cfg.get('normalization_constants', None)
         if normconst_path is None:
-            normalizer = Normalizer(
-                [(torch.Tensor(np.mean(b.reshape(-1, b.shape[-1]), axis=0)),
-                  torch.Tensor(np.std(b.reshape(-1, b.shape[-1]), axis=0)))
-                 for b in data_module.data]
-            )
+            normalizer = Normalizer([get_mean_and_std(b) for b in data_module.data])
         else:
             consts = load_from_hdf5(normconst_path)
             normalizer = Normalizer([
@@ -62,12 +58,7 @@ def construct_all_pl_components_for_training(
                 (torch.Tensor(consts['y_mean']), torch.Tensor(consts['y_std'])),
             ])
     elif cfg['normalization'] == 'standardize_input':
-        b = data_module.data[0]
-        normalizer = InputNormalizer(
-            [(torch.Tensor(np.mean(b.reshape(-1, b.shape[-1]), axis=0)),
-             torch.Tensor(np.std(b.reshape(-1, b.shape[-1]), axis=0)))
-             ]
-        )
+        normalizer = InputNormalizer([get_mean_and_std(data_module.data[0])])
     else:
         raise ValueError(f'Normalization scheme {cfg["normalization"]} not found.')
     model = hydra.utils.instantiate(cfg['model'], normalizer=normalizer,
@@ -111,6 +102,42 @@ def construct_all_pl_components_for_training(
     return model, data_module, trainer, logger, cfg
 
 
+def get_mean_and_std(
+        data: np.ndarray,
+        chunk_size: int = 4096,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Get the mean and standard deviation of each dimension of some data.
+
+    The data is read from memory once, a chunk at a time. Each chunk is small
+    enough to stay in cache while its mean and squared deviations are found, and
+    the chunks are then merged with Chan et al.'s pairwise update. This avoids
+    both the full size temporaries of np.std and the cancellation of taking the
+    difference of the first and second moments.
+
+    Args:
+        data: The data w shape (..., dim).
+        chunk_size: The number of rows to handle at a time.
+
+    Returns:
+        The mean and standard deviation, both w shape (dim,).
+    """
+    data = data.reshape(-1, data.shape[-1])
+    num_seen = 0
+    mean = np.zeros(data.shape[-1])
+    sq_devs = np.zeros(data.shape[-1])
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size].astype(np.float64)
+        chunk_mean = chunk.mean(axis=0)
+        chunk -= chunk_mean
+        delta = chunk_mean - mean
+        num_total = num_seen + len(chunk)
+        mean += delta * len(chunk) / num_total
+        sq_devs += (np.einsum('ij,ij->j', chunk, chunk)
+                    + delta ** 2 * num_seen * len(chunk) / num_total)
+        num_seen = num_total
+    return torch.Tensor(mean), torch.Tensor(np.sqrt(sq_devs / num_seen))
+
+
 def get_early_stopping_for_val_loss(cfg: DictConfig) -> pl.callbacks.EarlyStopping:
     """Get an early stopping callback with a certain patience.
 
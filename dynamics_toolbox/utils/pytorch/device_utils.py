@@ -17,6 +17,7 @@ class DeviceManager:
         """Constructor"""
         self.device = 'cpu'
         self._use_gpu = False
+        self._copy_event = None
 
     def set_cuda_device(self, device: Optional[int] = None):
         """Set the cuda device.
@@ -37,7 +38,28 @@ class DeviceManager:
         return torch.empty(*args, **kwargs, device=torch_device)
 
     def from_numpy(self, *args, **kwargs):
-        return torch.as_tensor(*args, **kwargs).float().to(self.device)
+        tensor = torch.as_tensor(*args, **kwargs)
+        if self._use_gpu and tensor.is_pinned():
+            # Copies out of pinned memory do not block, so remember when this one
+            # is done in case the memory is about to be reused.
+            tensor = tensor.to(self.device, non_blocking=True)
+            self._copy_event = torch.cuda.Event()
+            self._copy_event.record()
+        return tensor.float().to(self.device)
+
+    def host_zeros(self, *sizes, dtype=torch.float32) -> np.ndarray:
+        """Make numpy array of zeros that lives in pinned memory if using the gpu.
+
+        Moving pinned arrays to the gpu with from_numpy does not block, so before
+        writing to one again call wait_for_host_copies.
+        """
+        return torch.zeros(*sizes, dtype=dtype, pin_memory=self._use_gpu).numpy()
+
+    def wait_for_host_copies(self):
+        """Wait until all copies out of pinned memory have finished."""
+        if self._copy_event is not None:
+            self._copy_event.synchronize()
+            self._copy_event = None
 
     def get_numpy(self, tensor: torch.Tensor):
         return tensor.to('cpu').detach().numpy()
@@ -4,7 +4,8 @@ A basic multi-layer perceptron implementation.
 Author: Ian Char
 Date: July, 11 2021
 """
-from typing import Callable, Optional, Sequence
+import re
+from typing import Callable, Optional, Sequence, Union
 
 import torch
 from torch import Tensor
@@ -24,6 +25,8 @@ class FCNetwork(torch.nn.Module):
         num_heads: int = 1,
         head_hidden_sizes: Optional[Sequence[int]] = None,
         head_activation=F.relu,
+        dtype: Union[str, torch.dtype] = torch.float32,
+        autocast: bool = False,
     ):
         """Constructor.
 
@@ -38,40 +41,50 @@ class FCNetwork(torch.nn.Module):
             num_heads: The number of output heads.
             head_hidden_sizes: Number of hidden sizes for each head.
             head_activation: The activation function for each head network.
+            dtype: The dtype of the parameters, either as a torch dtype or its name
+                e.g. bfloat16. Inputs are cast to this dtype.
+            autocast: Whether to run the forward pass under bfloat16 autocast,
+                which uses the tensor cores of recent GPUs for the matmuls. The
+                output is then bfloat16 as well.
         """
         super().__init__()
         assert (out_activation is None
                 or num_heads == 1 or num_heads == len(out_activation))
         self._num_heads = num_heads
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        self._dtype = dtype
+        self._autocast = autocast
+        self._layers = torch.nn.ModuleList()
+        self._heads = torch.nn.ModuleList()
         if hidden_sizes is None:
             hidden_sizes = []
         if len(hidden_sizes) == 0:
-            self._add_linear_layer(input_dim, output_dim, 0)
-            self._n_layers = 1
+            self._add_linear_layer(input_dim, output_dim)
         else:
-            self._add_linear_layer(input_dim, hidden_sizes[0], 0)
+            self._add_linear_layer(input_dim, hidden_sizes[0])
             for hidx in range(len(hidden_sizes) - 1):
-                self._add_linear_layer(hidden_sizes[hidx],
-                                       hidden_sizes[hidx+1], hidx + 1)
+                self._add_linear_layer(hidden_sizes[hidx], hidden_sizes[hidx+1])
             if self._num_heads == 1:
                 assert head_hidden_sizes is None, ('Does not support one head '
                                                    'with hidden sizes')
-                self._add_linear_layer(hidden_sizes[-1], output_dim,
-                                       len(hidden_sizes))
+                self._add_linear_layer(hidden_sizes[-1], output_dim)
             else:
-                if head_hidden_sizes is None:
-                    for nh in range(self._num_heads):
-                        self._add_linear_layer(hidden_sizes[-1], output_dim,
-                                               layer_name=f'head_{nh}')
-                else:
-                    for nh in range(self._num_heads):
-                        setattr(self, f'head_{nh}', FCNetwork(
+                for nh in range(self._num_heads):
+                    if head_hidden_sizes is None:
+                        self._heads.append(torch.nn.Linear(
+                            hidden_sizes[-1],
+                            output_dim,
+                            dtype=dtype,
+                        ))
+                    else:
+                        self._heads.append(FCNetwork(
                             input_dim=hidden_sizes[-1],
                             output_dim=output_dim,
                             hidden_sizes=head_hidden_sizes,
                             hidden_activation=head_activation,
+                            dtype=dtype,
                         ))
-            self._n_layers = len(hidden_sizes) + 1
         self._hidden_activation = hidden_activation
         self._out_activation = out_activation
 
@@ -88,16 +101,38 @@ class FCNetwork(torch.nn.Module):
             The output of the network w shape (out_dim,) if one head or
             (n_heads, out_dim) if there are multiple heads.
         """
-        curr = net_in
-        for layer_num in range(self._n_layers - 1):
-            curr = getattr(self, f'linear_{layer_num}')(curr)
-            curr = self._hidden_activation(curr)
+        if self._autocast:
+            with torch.autocast(device_type=net_in.device.type, dtype=torch.bfloat16):
+                return self._forward(net_in)
+        return self._forward(net_in)
+
+    def _forward(
+            self,
+            net_in: Tensor,
+    ) -> Tensor:
+        """Forward pass through network without any autocasting.
+
+        Args:
+            net_in: The input to the network.
+
+        Returns:
+            The output of the network.
+        """
+        # The layers are applied with F.linear rather than being called since the
+        # module call machinery is a large part of the cost for small networks.
+        curr = net_in.to(self._dtype)
         if self._num_heads == 1:
-            curr = getattr(self, f'linear_{self._n_layers - 1}')(curr)
+            *hidden, last = self._layers
+        else:
+            hidden, last = self._layers, None
+        for layer in hidden:
+            curr = self._hidden_activation(F.linear(curr, layer.weight, layer.bias))
+        if last is not None:
+            curr = F.linear(curr, last.weight, last.bias)
             if self._out_activation is not None:
                 return self._out_activation(curr)
             return curr
-        currs = [getattr(self, f'head_{nh}')(curr) for nh in range(self._num_heads)]
+        currs = [head(curr) for head in self._heads]
         if self._out_activation is not None:
             currs = [outf(curr) for outf, curr in zip(self._out_activation, currs)]
         return torch.stack(currs)
@@ -105,7 +140,7 @@ class FCNetwork(torch.nn.Module):
     @property
     def n_layers(self) -> int:
         """Number of layers in the network."""
-        return self._n_layers
+        return len(self._layers) + (len(self._heads) > 0)
 
     @property
     def hidden_activation(self) -> Callable[[Tensor], Tensor]:
@@ -119,26 +154,38 @@ class FCNetwork(torch.nn.Module):
 
     def get_layer(self, layer_num: int) -> torch.nn.Linear:
         """Return a specific layer."""
-        return getattr(self, f'linear_{layer_num}')
+        return self._layers[layer_num]
 
     def _add_linear_layer(
             self,
             lin_in: int,
             lin_out: int,
-            layer_num: Optional[int] = None,
-            layer_name: Optional[str] = None,
     ) -> None:
-        """Add a linear layer to the network.
+        """Add a linear layer to the end of the network.
 
         Args:
             lin_in: Input dimension to the layer.
             lin_out: Output dimension of the layer.
-            layer_num: The number of the layer being added.
-            layer_name: The name of the layer.
         """
-        layer = torch.nn.Linear(lin_in, lin_out)
-        if layer_name is None:
-            if layer_num is None:
-                raise ValueError('Either layer_num or layer_name must be provided')
-            layer_name = f'linear_{layer_num}'
-        self.add_module(layer_name, layer)
+        self._layers.append(torch.nn.Linear(lin_in, lin_out, dtype=self._dtype))
+
+    def _load_from_state_dict(
+            self,
+            state_dict,
+            prefix,
+            *args,
+            **kwargs,
+    ):
+        """Load the state dict, renaming layers saved under their old names.
+
+        Layers used to be registered as linear_<num> and head_<num> rather than
+        being held in module lists.
+        """
+        legacy = re.compile(re.escape(prefix) + r'(linear|head)_(\d+)\.')
+        for key in list(state_dict.keys()):
+            match = legacy.match(key)
+            if match is not None:
+                list_name = '_layers' if match.group(1) == 'linear' else '_heads'
+                new_key = f'{prefix}{list_name}.{match.group(2)}.{key[match.end():]}'
+                state_dict[new_key] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -6,6 +6,14 @@ Date: April 10, 2023
 """
 import os
 
+# Hydra runs every job in a fresh directory, so the compiled numba kernels are
+# cached in one fixed place that is shared across runs. This has to be set
+# before numba is first imported.
+os.environ.setdefault(
+    'NUMBA_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'dynamics_toolbox', 'numba'),
+)
+
 import hydra
 from omegaconf import DictConfig, OmegaConf, open_dict
 